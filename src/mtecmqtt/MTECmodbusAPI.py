@@ -3,12 +3,59 @@
 Modbus API for M-TEC Energybutler
 (c) 2023 by Christian Rödel 
 """
-from mtecmqtt.config import cfg, register_map
+from mtecmqtt import config
 from pymodbus.client import ModbusTcpClient
-from pymodbus.payload import BinaryPayloadDecoder
-from pymodbus.constants import Endian
 from pymodbus.framer import Framer
 import logging
+import struct
+import socket
+from collections import OrderedDict
+
+MODBUS_MAX_REGISTERS = 120 # Max. number of registers fetched by one read request (modbus limit is 125)
+CLUSTER_CACHE_SIZE = 64 # Max. number of cached register clusters (one per combination of groups read at once)
+
+#-----------------------------------------------------
+# Decoders for all supported register types. 
+# Signature: decoder(buf, pos, length) - buf: raw bytes (big endian), pos: byte position, length: number of registers 
+def _numeric_decoder( fmt ):
+  unpack_from = struct.Struct(fmt).unpack_from
+  return lambda buf, pos, length: unpack_from(buf, pos)[0]
+
+BYTE_FORMATS = {
+  1: "{:02d} {:02d}",
+  2: "{:02d} {:02d}  {:02d} {:02d}",
+  4: "{:02d} {:02d} {:02d} {:02d}  {:02d} {:02d} {:02d} {:02d}",
+}
+
+BIT_FORMATS = {
+  1: "{:08b}",
+  2: "{:08b} {:08b}",
+}
+
+def _decode_byte( buf, pos, length ):
+  fmt = BYTE_FORMATS.get(length)
+  return fmt.format( *buf[pos:pos+length*2] ) if fmt else None
+
+def _decode_bit( buf, pos, length ):
+  fmt = BIT_FORMATS.get(length)
+  return fmt.format( *buf[pos:pos+length] ) if fmt else None
+
+def _decode_dat( buf, pos, length ):
+  return "{:02d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format( *buf[pos:pos+6] )
+
+def _decode_str( buf, pos, length ):
+  return buf[pos:pos+length*2].decode()
+
+DECODERS = {
+  "U16": _numeric_decoder(">H"),
+  "I16": _numeric_decoder(">h"),
+  "U32": _numeric_decoder(">I"),
+  "I32": _numeric_decoder(">i"),
+  "BYTE": _decode_byte,
+  "BIT": _decode_bit,
+  "DAT": _decode_dat,
+  "STR": _decode_str,
+}
 
 #=====================================================
 class MTECmodbusAPI:
@@ -16,7 +63,8 @@ class MTECmodbusAPI:
   def __init__( self ):
     self.modbus_client = None
     self.slave = 0
-    self._cluster_cache = {}
+    self._cluster_cache = OrderedDict()
+    self._tuned_socket = None
     logging.debug("API initialized")
 
   def __del__(self):
@@ -27,6 +75,7 @@ class MTECmodbusAPI:
   def connect( self, ip_addr, port, slave ):
     self.slave = slave
     
+    cfg = config.cfg
     framer = cfg.get("MODBUS_FRAMER", "rtu")
     logging.debug("Connecting to server {}:{} (framer={})".format(ip_addr, port, framer))
     self.modbus_client = ModbusTcpClient(ip_addr, port, framer=Framer(framer), timeout=cfg["MODBUS_TIMEOUT"],
@@ -34,11 +83,27 @@ class MTECmodbusAPI:
 
     if self.modbus_client.connect():
       logging.debug("Successfully connected to server {}:{}".format(ip_addr, port))
+      self._tune_socket()
       return True
     else:
       logging.error("Couldn't connect to server {}:{}".format(ip_addr, port))
       return False
 
+  #-------------------------------------------------
+  # Send small modbus requests immediately and detect dead connections by TCP keep-alive.
+  # pymodbus re-connects automatically after connection errors, so this is re-applied to each new socket.
+  def _tune_socket( self ):
+    sock = self.modbus_client.socket
+    if sock and sock is not self._tuned_socket:
+      try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"): # not available on all platforms
+          sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+      except OSError as ex:
+        logging.debug("Couldn't set socket options: {}".format(ex))
+      self._tuned_socket = sock
+
   #-------------------------------------------------
   # Disconnect from Modbus server
   def disconnect( self ):
@@ -47,14 +112,10 @@ class MTECmodbusAPI:
       logging.debug("Successfully disconnected from server")
 
 #--------------------------------
-  # Get a list of all registers which belong to a given group
+  # Get all registers which belong to a given group (as tuple, since it is shared with the register map)
   def get_register_list( self, group ):
-    registers = []
-    for register, item in register_map.items():
-      if item["group"] == group:
-        registers.append(register)
-
-    if len(registers)==0:
+    registers = config.registers_by_group.get(group)
+    if not registers:
       logging.error("Unknown or empty register group: {}".format(group))
       return None              
     return registers
@@ -65,11 +126,8 @@ class MTECmodbusAPI:
     data = {}
     logging.debug("Retrieving data...")
 
-    if registers == None: # Create liset of all (numeric) registers
-      registers = []
-      for register in register_map:
-        if register.isnumeric(): # non-numeric registers are deemed to be calculated pseudo-registers
-          registers.append(register)
+    if registers == None: # Use list of all (numeric) registers
+      registers = config.numeric_registers
 
     cluster_list = self._get_register_clusters(registers)
     for reg_cluster in cluster_list:
@@ -77,15 +135,15 @@ class MTECmodbusAPI:
       logging.debug("Fetching data for cluster start {}, length {}, items {}".format(reg_cluster["start"], reg_cluster["length"], len(reg_cluster["items"])))
       rawdata = self._read_registers(reg_cluster["start"], reg_cluster["length"])
       if rawdata:
-        for item in reg_cluster["items"]:
-          if item.get("type"): # type==None means dummy
-            data_decoded = self._decode_rawdata(rawdata, offset, item)
+        buf = struct.pack(">{}H".format(len(rawdata.registers)), *rawdata.registers) # raw bytes of the whole cluster 
+        for register, decoder, length, scale, name, unit in reg_cluster["items"]:
+          if decoder: # decoder==None means dummy
+            data_decoded = self._decode_rawdata(buf, offset, decoder, length, scale, name, unit)
             if data_decoded:
-              register = str(reg_cluster["start"] + offset)
-              data.update( {register: data_decoded} )
+              data[register] = data_decoded
             else:
               logging.error("Decoding error while decoding register {}".format(register))
-          offset += item["length"]
+          offset += length
 
     logging.debug("Data retrieval completed")
     return data
@@ -94,7 +152,7 @@ class MTECmodbusAPI:
   # Write a value to a register
   def write_register(self, register, value):
     # Lookup register
-    item = register_map.get(str(register), None)
+    item = config.register_map.get(str(register), None)
     if not item:
       logging.error("Can't write unknown register: {}".format(register))
       return False
@@ -131,11 +189,17 @@ class MTECmodbusAPI:
   #--------------------------------
   # Cluster registers in order to optimize modbus traffic    
   def _get_register_clusters( self, registers ):
-    # Cache clusters to avoid unnecessary overhead
-    idx = str(registers) # use stringified version of list as index
-    if idx not in self._cluster_cache:
-      self._cluster_cache[idx] = self._create_register_clusters(registers)
-    return self._cluster_cache[idx]
+    # Cache clusters to avoid unnecessary overhead (LRU cache with limited size)
+    idx = tuple(registers) # use tuple version of list as index
+    cluster_list = self._cluster_cache.get(idx)
+    if cluster_list is None:
+      cluster_list = self._create_register_clusters(registers)
+      self._cluster_cache[idx] = cluster_list
+      if len(self._cluster_cache) > CLUSTER_CACHE_SIZE:
+        self._cluster_cache.popitem(last=False) # drop least recently used entry
+    else:
+      self._cluster_cache.move_to_end(idx)
+    return cluster_list
 
   # Create clusters     
   def _create_register_clusters( self, registers ):
@@ -146,24 +210,37 @@ class MTECmodbusAPI:
     }
     cluster_list = []
     
-    for register in sorted(registers):
-      if register.isnumeric(): # ignore non-numeric pseudo registers
-        item = register_map.get(register)
-        if item:
-          if int(register) > cluster["start"] + cluster["length"]: # there is a gap 
-            if cluster["start"] > 0: # except for first cluster 
-              cluster_list.append(cluster)
-            cluster = { 
-              "start": int(register),     
-              "length": 0,
-              "items": []   
-            }
-          cluster["length"] += item["length"]  
-          cluster["items"].append(item)
-        else:
-          logging.warning("Unknown register: {} - skipped.".format(register))
+    register_map = config.register_map
+    if registers is not config.numeric_registers: # numeric_registers is already sorted
+      registers = sorted((r for r in registers if r.isnumeric()), key=int) # ignore non-numeric pseudo registers
+    max_gap = config.cfg.get("MODBUS_MAX_GAP", 0) # max. number of unused registers which are read in order to avoid a separate request
+    cluster_end = 0 # address following the current cluster
+    for register in registers:
+      item = register_map.get(register)
+      if item:
+        reg_int = int(register)
+        gap = reg_int - cluster_end
+        if not cluster["items"] or gap > max_gap or max(reg_int, cluster_end) + item["length"] - cluster["start"] > MODBUS_MAX_REGISTERS: # start a new cluster
+          if cluster["items"]: # except for first cluster 
+            cluster_list.append(cluster)
+          cluster = { 
+            "start": reg_int,     
+            "length": 0,
+            "items": []   
+          }
+          cluster_end = reg_int
+        elif gap > 0: # bridge the gap with a dummy item
+          cluster["length"] += gap
+          cluster["items"].append( (None, None, gap, 1, None, None) )
+          cluster_end += gap
+        decoder = DECODERS[item["type"]] if item["type"] else None # type==None means dummy; types are validated by init_register_map
+        cluster["length"] += item["length"]  
+        cluster_end += item["length"]
+        cluster["items"].append( (register, decoder, item["length"], item["scale"], item["name"], item["unit"]) ) # resolve decoder and item attributes once per cached cluster
+      else:
+        logging.warning("Unknown register: {} - skipped.".format(register))
 
-    if cluster["start"] > 0: # append last cluster
+    if cluster["items"]: # append last cluster
       cluster_list.append(cluster)
 
     return cluster_list
@@ -176,6 +253,7 @@ class MTECmodbusAPI:
     except Exception as ex:
       logging.error("Exception while reading register {}, length {} from pymodbus: {}".format(register, length, ex))
       return None
+    self._tune_socket() # in case pymodbus had to re-connect
     if result.isError():
       logging.error("Error while reading register {}, length {} from pymodbus".format(register, length))
       return None
@@ -185,48 +263,13 @@ class MTECmodbusAPI:
     return result
 
   #--------------------------------
-  # Decode the result from rawdata, starting at offset
-  def _decode_rawdata(self, rawdata, offset, item):
+  # Decode the item from the raw bytes buffer, starting at register offset
+  def _decode_rawdata(self, buf, offset, decoder, length, scale, name, unit):
     try:
-      val = None
-      start = rawdata.registers[offset:]
-      decoder = BinaryPayloadDecoder.fromRegisters(registers=start, byteorder=Endian.BIG, wordorder=Endian.BIG)
-      if item["type"] == 'U16':
-        val = decoder.decode_16bit_uint()
-      elif item["type"] == 'I16':
-        val = decoder.decode_16bit_int()
-      elif item["type"] == 'U32':
-        val = decoder.decode_32bit_uint()
-      elif item["type"] == 'I32':
-        val = decoder.decode_32bit_int()
-      elif item["type"] == 'BYTE':
-        if item["length"] == 1:
-          val = "{:02d} {:02d}".format( decoder.decode_8bit_uint(), decoder.decode_8bit_uint() )
-        elif item["length"] == 2:
-          val = "{:02d} {:02d}  {:02d} {:02d}".format( decoder.decode_8bit_uint(), decoder.decode_8bit_uint(), 
-                                                    decoder.decode_8bit_uint(), decoder.decode_8bit_uint() )
-        elif item["length"] == 4:
-          val = "{:02d} {:02d} {:02d} {:02d}  {:02d} {:02d} {:02d} {:02d}".format( decoder.decode_8bit_uint(), decoder.decode_8bit_uint(), 
-                                                    decoder.decode_8bit_uint(), decoder.decode_8bit_uint(),
-                                                    decoder.decode_8bit_uint(), decoder.decode_8bit_uint(), 
-                                                    decoder.decode_8bit_uint(), decoder.decode_8bit_uint() )
-      elif item["type"] == 'BIT':
-        if item["length"] == 1:
-          val = "{:08b}".format( decoder.decode_8bit_uint() )
-        if item["length"] == 2:
-          val = "{:08b} {:08b}".format( decoder.decode_8bit_uint(), decoder.decode_8bit_uint() )
-      elif item["type"] == 'DAT':
-        val = "{:02d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format( decoder.decode_8bit_uint(), decoder.decode_8bit_uint(), decoder.decode_8bit_uint(),
-                        decoder.decode_8bit_uint(), decoder.decode_8bit_uint(), decoder.decode_8bit_uint() )
-      elif item["type"] == 'STR':
-        val = decoder.decode_string(item["length"]*2).decode()
-      else:
-        logging.error("Unknown type {} to decode".format(item["type"]))
-        return None
-      
-      if val and item["scale"] > 1:
-        val /= item["scale"]
-      data = { "name":item["name"], "value":val, "unit":item["unit"] } 
+      val = decoder(buf, offset*2, length)
+      if val and scale > 1:
+        val /= scale
+      data = { "name":name, "value":val, "unit":unit } 
       return data
     except Exception as ex:
       logging.error("Exception while decoding data: {}".format(ex))
@@ -235,7 +278,8 @@ class MTECmodbusAPI:
 #--------------------------------
 # The main() function is just a demo code how to use the API
 def main():
-  logging.basicConfig()
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
+  cfg = config.cfg
   if cfg['DEBUG'] == True:
     logging.getLogger().setLevel(logging.DEBUG)
 
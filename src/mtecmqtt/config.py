@@ -3,10 +3,40 @@ Read YAML config files
 (c) 2024 by Christian Rödel 
 """
 import yaml
+try:
+  from yaml import CSafeLoader as SafeLoader # use libyaml C binding if available
+except ImportError:
+  from yaml import SafeLoader
 import os
 import sys
 import logging
 import socket
+import marshal
+import functools
+
+REGISTER_CACHE_VERSION = 9  # Increase whenever the post-processing in init_register_map changes
+
+# Mandatory register parameters
+REGISTER_MANDATORY = [
+  "name", 
+]
+
+# Optional register parameters and their defaults
+REGISTER_DEFAULTS = { 
+  "length": None, 
+  "type": None,
+  "unit": "",
+  "scale": 1,
+  "writable": False,
+  "mqtt": None,
+  "group": None,
+} 
+
+# Optional register parameters which have to be integers
+REGISTER_INTEGERS = [ "length", "scale" ]
+
+# Supported register types
+REGISTER_TYPES = [ "U16", "I16", "U32", "I32", "BYTE", "BIT", "DAT", "STR" ]
 
 #----------------------------------------
 # Create new config file
@@ -72,9 +102,12 @@ def init_config():
   
   cfg = False
   for fname_conf in conf_files:
+    if not os.path.isfile(fname_conf):
+      logging.debug("Config YAML file not found: {}".format(fname_conf) )
+      continue
     try:
-      with open(fname_conf, 'r', encoding='utf-8') as f_conf:
-        cfg = yaml.safe_load(f_conf)
+      with open(fname_conf, 'rb') as f_conf:
+        cfg = yaml.load(f_conf.read(), Loader=SafeLoader) # parse whole file from one buffer
         logging.info("Using config YAML file: {}".format(fname_conf) )      
         break
     except IOError as err:
@@ -84,14 +117,62 @@ def init_config():
 
   return cfg  
 
+#----------------------------------------
+# Location of the pre-processed register map cache
+def get_register_cache_fname():
+  cache_path = os.environ.get('XDG_CACHE_HOME')
+  if not cache_path: # Usually something like ~/.cache/mtecmqtt/registers.yaml.cache
+    cache_path = os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(cache_path, "mtecmqtt", "registers.yaml.cache")
+
+# Load register map from cache - returns None if cache is missing or outdated
+def load_register_cache( fname_cache, fname_regs, stat_regs ):
+  try:
+    with open(fname_cache, 'rb') as f_cache:
+      version, fname, mtime_ns, size, register_map, register_groups, registers_by_group = marshal.load(f_cache)
+  except (IOError, EOFError, ValueError, TypeError) as err:
+    logging.debug("Couldn't read registers cache file {}: {}".format(fname_cache, str(err)) )
+    return None
+  if version != REGISTER_CACHE_VERSION or fname != fname_regs or mtime_ns != stat_regs.st_mtime_ns or size != stat_regs.st_size:
+    logging.debug("Registers cache file {} is outdated".format(fname_cache) )
+    return None
+  return register_map, register_groups, registers_by_group
+
+# Write register map to cache - written to a temporary file first, so a concurrent reader never sees a partial cache
+def write_register_cache( fname_cache, fname_regs, stat_regs, register_map, register_groups, registers_by_group ):
+  fname_tmp = "{}.{}.tmp".format(fname_cache, os.getpid())
+  try:
+    os.makedirs(os.path.dirname(fname_cache), exist_ok=True)
+    with open(fname_tmp, 'wb') as f_cache:
+      marshal.dump( (REGISTER_CACHE_VERSION, fname_regs, stat_regs.st_mtime_ns, stat_regs.st_size, register_map, register_groups, registers_by_group), f_cache )
+    os.replace(fname_tmp, fname_cache)
+  except (IOError, ValueError) as err:
+    logging.debug("Couldn't write registers cache file {}: {}".format(fname_cache, str(err)) )
+    try:
+      os.remove(fname_tmp)
+    except OSError:
+      pass
+
 #----------------------------------------
 # Read inverter registers and their mapping from YAML file
 def init_register_map():
   BASE_DIR = os.path.dirname(__file__) # Base installation directory
+  fname_regs = os.path.join(BASE_DIR, "registers.yaml")
+  fname_cache = get_register_cache_fname()
   try:
-    fname_regs = os.path.join(BASE_DIR, "registers.yaml")
-    with open(fname_regs, 'r', encoding='utf-8') as f_regs:
-      r_map = yaml.safe_load(f_regs)
+    stat_regs = os.stat(fname_regs)
+  except OSError as err:
+    logging.fatal("Couldn't open registers YAML file: {}".format(str(err)))
+    sys.exit(1)
+
+  # Use pre-processed register map, if registers.yaml didn't change
+  cached = load_register_cache(fname_cache, fname_regs, stat_regs)
+  if cached:
+    return cached
+
+  try:
+    with open(fname_regs, 'rb') as f_regs:
+      r_map = yaml.load(f_regs.read(), Loader=SafeLoader) # parse whole file from one buffer
   except IOError as err:
     logging.fatal("Couldn't open registers YAML file: {}".format(str(err)))
     sys.exit(1)
@@ -101,59 +182,92 @@ def init_register_map():
     
   # Syntax checks 
   register_map = {}
-  p_mandatory = [
-    "name", 
-  ]
-  p_optional = [ 
-    # param, default
-    [ "length", None ], 
-    [ "type", None ],
-    [ "unit", "" ],
-    [ "scale", 1 ],
-    [ "writable", False ],
-    [ "mqtt", None ],
-    [ "group", None ],
-  ] 
-  register_groups = []
+  register_groups = {} # used as insertion-ordered set
+  registers_by_group = {}
 
   for key, val in r_map.items():
     # Check for mandatory paramaters
-    for p in p_mandatory: 
-      error = False
+    error = False
+    for p in REGISTER_MANDATORY: 
       if not val.get(p):
         logging.warning("Skipping invalid register config: {}. Missing mandatory parameter: {}.".format( key, p ))
         error = True
         break
 
-    if not error: # All madatory parameters found   
-      item = val.copy()  
-      # Check optional parameters and add defaults, if not found
-      for p in p_optional:  
-        if not item.get(p[0]):
-          item[p[0]] = p[1]
+    if not error and key.isnumeric() and val.get("type") and val["type"] not in REGISTER_TYPES:
+      logging.warning("Skipping invalid register config: {}. Unknown type: {}.".format( key, val["type"] ))
+      error = True
+
+    if not error: # All madatory parameters found
+      item = val.copy()
+      for p, default in REGISTER_DEFAULTS.items(): # Add defaults for missing or empty optional parameters
+        if not item.get(p):
+          item[p] = default
+      for p in REGISTER_INTEGERS:
+        value = item[p]
+        if isinstance(value, float) and value.is_integer(): # e.g. "scale: 10.0"
+          value = int(value)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+          logging.warning("Skipping invalid register config: {}. Parameter {} is not an integer: {}.".format( key, p, item[p] ))
+          error = True
+          break
+        item[p] = value
+
+    if not error and key.isnumeric() and item["length"] is None: # modbus registers are read by length
+      logging.warning("Skipping invalid register config: {}. Missing parameter: length.".format( key ))
+      error = True
+
+    if not error: # All parameters valid
+      # Do home assistant registration if there is a "hass_" config entry
+      do_hass_registration = any(param.startswith("hass_") for param in val)
+      item["_hass_component_type"] = item.get("hass_component_type", "sensor") if do_hass_registration else None
       register_map[key] = item # Append to register_map
-      if item["group"] and item["group"] not in register_groups:
-        register_groups.append(item["group"]) # Append to group list
-  return register_map, register_groups
+      if item["group"]:
+        register_groups[item["group"]] = None # Append to group list
+        registers_by_group.setdefault(item["group"], []).append(key) # Append to group index
+
+  register_groups = list(register_groups)
+  registers_by_group = { group: tuple(registers) for group, registers in registers_by_group.items() } # shared by all callers, so make it immutable
+  write_register_cache(fname_cache, fname_regs, stat_regs, register_map, register_groups, registers_by_group)
+  return register_map, register_groups, registers_by_group
 
 #----------------------------------------
-logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
-cfg = init_config()
-if not cfg:
-  if create_config_file():  # Create a new config
-    cfg = init_config()
-    if not cfg:
-      logging.fatal("Couldn't open config YAML file")
+# Lazy initialization: config and register map are read on first access.
+# Modules should use "from mtecmqtt import config" and access config.cfg etc. at runtime, 
+# since "from mtecmqtt.config import cfg" would read the config already on import.
+@functools.lru_cache(maxsize=None)
+def get_config():
+  cfg = init_config()
+  if not cfg:
+    if create_config_file():  # Create a new config
+      cfg = init_config()
+      if not cfg:
+        logging.fatal("Couldn't open config YAML file")
+        sys.exit(1)
+    else:
+      logging.fatal("Couldn't create config YAML file")
       sys.exit(1)
-  else:
-    logging.fatal("Couldn't create config YAML file")
-    sys.exit(1)
+  return cfg
+
+@functools.lru_cache(maxsize=None)
+def get_register_map():
+  register_map, register_groups, registers_by_group = init_register_map()
+  numeric_registers = sorted((r for r in register_map if r.isnumeric()), key=int) # non-numeric registers are deemed to be calculated pseudo-registers
+  return register_map, register_groups, registers_by_group, numeric_registers
+
+REGISTER_MAP_ATTRS = [ "register_map", "register_groups", "registers_by_group", "numeric_registers" ] # order of get_register_map() result
 
-register_map, register_groups = init_register_map()
+# Module attributes cfg, register_map, ... are resolved on first access (PEP 562)
+def __getattr__( name ):
+  if name == "cfg":
+    return get_config()
+  if name in REGISTER_MAP_ATTRS:
+    return get_register_map()[REGISTER_MAP_ATTRS.index(name)]
+  raise AttributeError("module {} has no attribute {}".format(__name__, name))
 
 #--------------------------------------
 # Test code only
 if __name__ == "__main__":
-  logging.info( "Config: {}".format( str(cfg)) )
-  logging.info( "Register_map: {}".format( str(register_map)) )
-  
\ No newline at end of file
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
+  logging.info( "Config: {}".format( str(get_config())) )
+  logging.info( "Register_map: {}".format( str(get_register_map()[0])) )
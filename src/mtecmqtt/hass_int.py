@@ -4,13 +4,19 @@ Auto discovery for home assistant
 (c) 2024 by Christian Rödel 
 """
 
-from mtecmqtt.config import cfg, register_map
+from mtecmqtt import config
 import logging
 import json
-from mtecmqtt.mqtt import mqtt_publish
+import threading
+from mtecmqtt.mqtt import mqtt_publish_batch
+
+SERIAL_NO_PLACEHOLDER = "%SERIAL_NO%" # Placeholder for the serial number in discovery templates
 
 #---------------------------------------------------
 class HassIntegration:
+  # Serialized discovery info with serial number placeholder - built only once 
+  discovery_templates = None
+
   # Custom automations
   buttons = [
     # name                        unique_id                   payload_press              
@@ -20,77 +26,98 @@ class HassIntegration:
   #-------------------------------------------------
   def __init__(self):
     self.serial_no = None
+    self.hass_base_topic = config.cfg["HASS_BASE_TOPIC"]
     self.is_initialized = False
     self.devices_array=[]
+    self.discovery_timer = None # Pending delayed send of discovery info
 
   #---------------------------------------------------
   def initialize( self, serial_no ):
     self.serial_no = serial_no
-    self.device_info = { 
-      "identifiers": [ self.serial_no ],
+    if not HassIntegration.discovery_templates:
+      HassIntegration.discovery_templates = self._build_discovery_templates( self.hass_base_topic )
+    serial_no_json = json.dumps(self.serial_no)[1:-1] # JSON escaped serial number without quotes 
+    self.devices_array = [ [topic, payload.replace(SERIAL_NO_PLACEHOLDER, serial_no_json)] for topic, payload in HassIntegration.discovery_templates ]
+    self.is_initialized = True # set before sending, so discovery info is (re-)sent on connect to the MQTT broker
+    self.send_discovery_info()
+
+  #---------------------------------------------------
+  # build serialized discovery info using a placeholder for the serial number
+  @classmethod
+  def _build_discovery_templates( cls, hass_base_topic ):
+    state_topic_base = "MTEC/" + SERIAL_NO_PLACEHOLDER + "/"
+    device_info = { 
+      "identifiers": [ SERIAL_NO_PLACEHOLDER ],
       "name": "MTEC Energybutler", 
       "manufacturer": "MTEC", 
       "model": "Energybutler",
       "via_device": "MTECmqtt" 
     }  
-    self.devices_array.clear()
-    self._build_devices_array()
-    self._build_automation_array()
-    self.send_discovery_info()
-    self.is_initialized = True  
+    return ( cls._build_devices_array( hass_base_topic, state_topic_base, device_info ) 
+           + cls._build_automation_array( hass_base_topic, state_topic_base, device_info ) )
 
   #---------------------------------------------------
   def send_discovery_info( self ):
     logging.info('Sending home assistant discovery info')
-    for device in self.devices_array:
-      mqtt_publish( topic=device[0], payload=device[1] ) 
+    mqtt_publish_batch( self.devices_array )
+
+  #---------------------------------------------------
+  # send discovery info after a delay, without blocking the caller (i.e. the MQTT network loop)
+  def schedule_discovery_info( self, delay ):
+    if self.discovery_timer: # only one pending send at a time
+      self.discovery_timer.cancel()
+    self.discovery_timer = threading.Timer(delay, self.send_discovery_info)
+    self.discovery_timer.daemon = True
+    self.discovery_timer.start()
 
   #---------------------------------------------------
   def send_unregister_info( self ):
+    if self.discovery_timer:
+      self.discovery_timer.cancel()
     logging.info('Sending info to unregister from home assistant')
-    for device in self.devices_array:
-      mqtt_publish( topic=device[0], payload="" ) 
+    mqtt_publish_batch( [ [device[0], ""] for device in self.devices_array ] )
 
   #---------------------------------------------------
-  def _build_automation_array( self ):
+  @classmethod
+  def _build_automation_array( cls, hass_base_topic, state_topic_base, device_info ):
+    automations = []
     # Buttons
-    for item in self.buttons:
+    for item in cls.buttons:
       data_item = { 
         "name": item[0], 
         "unique_id": item[1], 
         "payload_press": item[2],
-        "command_topic": "MTEC/" + self.serial_no + "/automations/command",
-        "device": self.device_info
+        "command_topic": state_topic_base + "automations/command",
+        "device": device_info
       }
-      topic = cfg["HASS_BASE_TOPIC"] + "/button/" + item[1] + "/config"
-      self.devices_array.append( [topic, json.dumps(data_item)] )  
+      topic = hass_base_topic + "/button/" + item[1] + "/config"
+      automations.append( [topic, json.dumps(data_item)] )  
+    return automations
 
   #---------------------------------------------------
   # build discovery data for devices
-  def _build_devices_array( self ):
-    for register, item in register_map.items():
-      # Do registration if there is a "hass_" config entry
-      do_hass_registration = False
-      for key in item.keys():
-        if "hass_" in key:
-          do_hass_registration = True
-          break
-
-      if item["group"] and do_hass_registration: 
-        component_type = item.get("hass_component_type", "sensor")
+  @classmethod
+  def _build_devices_array( cls, hass_base_topic, state_topic_base, device_info ):
+    devices = []
+    for item in config.register_map.values():
+      component_type = item["_hass_component_type"] # None if no hass registration required
+      if component_type and item["group"]: 
         if component_type == "sensor":
-          self._append_sensor(item)   
-        if component_type == "binary_sensor":
-          self._append_binary_sensor(item)   
+          devices.append( cls._sensor_config(item, hass_base_topic, state_topic_base, device_info) )
+        elif component_type == "binary_sensor":
+          devices.append( cls._binary_sensor_config(item, hass_base_topic, state_topic_base, device_info) )
+    return devices
 
   #---------------------------------------------------
-  def _append_sensor( self, item ):               
+  @staticmethod
+  def _sensor_config( item, hass_base_topic, state_topic_base, device_info ):               
+    mqtt_id = "MTEC_" + item["mqtt"]
     data_item = { 
       "name": item["name"], 
-      "unique_id": "MTEC_" + item["mqtt"], 
+      "unique_id": mqtt_id, 
       "unit_of_measurement": item["unit"],
-      "state_topic": "MTEC/" + self.serial_no + "/" + item["group"] + "/" + item["mqtt"],
-      "device": self.device_info
+      "state_topic": state_topic_base + item["group"] + "/" + item["mqtt"],
+      "device": device_info
     }
     if item.get("hass_device_class"):
       data_item["device_class"] = item["hass_device_class"] 
@@ -99,16 +126,18 @@ class HassIntegration:
     if item.get("hass_state_class"):
       data_item["state_class"] = item["hass_state_class"] 
 
-    topic = cfg["HASS_BASE_TOPIC"] + "/sensor/" + "MTEC_" + item["mqtt"] + "/config"
-    self.devices_array.append( [topic, json.dumps(data_item)] )  
+    topic = hass_base_topic + "/sensor/" + mqtt_id + "/config"
+    return [topic, json.dumps(data_item)]
 
 #---------------------------------------------------
-  def _append_binary_sensor( self, item ):               
+  @staticmethod
+  def _binary_sensor_config( item, hass_base_topic, state_topic_base, device_info ):               
+    mqtt_id = "MTEC_" + item["mqtt"]
     data_item = { 
       "name": item["name"], 
-      "unique_id": "MTEC_" + item["mqtt"], 
-      "state_topic": "MTEC/" + self.serial_no + "/" + item["group"] + "/" + item["mqtt"],
-      "device": self.device_info
+      "unique_id": mqtt_id, 
+      "state_topic": state_topic_base + item["group"] + "/" + item["mqtt"],
+      "device": device_info
     }
     if item.get("hass_device_class"):
       data_item["device_class"] = item["hass_device_class"] 
@@ -117,12 +146,13 @@ class HassIntegration:
     if item.get("hass_payload_off"):
       data_item["payload_off"] = item["hass_payload_off"] 
 
-    topic = cfg["HASS_BASE_TOPIC"] + "/binary_sensor/" + "MTEC_" + item["mqtt"] + "/config"
-    self.devices_array.append( [topic, json.dumps(data_item)] )  
+    topic = hass_base_topic + "/binary_sensor/" + mqtt_id + "/config"
+    return [topic, json.dumps(data_item)]
 
 #---------------------------------------------------
 # Testcode only
 def main():
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
   hass = HassIntegration()
   hass.initialize( "my_serial_number" )
 
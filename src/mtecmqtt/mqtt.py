@@ -4,42 +4,52 @@ MQTT client base implemantation
 (c) 2024 by Christian Rödel 
 """
 import logging
-from mtecmqtt.config import cfg
-import time
+from mtecmqtt import config
 
 try:
   import paho.mqtt.client as mqttcl
-  import paho.mqtt.publish as publish
 except Exception as e:
   logging.warning("MQTT not set up because of: {}".format(e))
+
+mqtt_client = None # Persistent client, used for all publishing
     
 # ============ MQTT ================
 def on_mqtt_connect(mqttclient, userdata, flags, rc, prop):
+  if rc.is_failure: # network loop keeps retrying
+    logging.warning("Couldn't connect to MQTT broker: {}".format(str(rc)))
+    return
   logging.info("Connected to MQTT broker")
+  if userdata: # (re-)subscribe to home assistant status
+    mqttclient.subscribe(config.cfg["HASS_BASE_TOPIC"]+"/status", qos=0)
+    if userdata.is_initialized: # discovery info might have been sent while not connected
+      userdata.send_discovery_info()
 
 def on_mqtt_message(mqttclient, userdata, message):
   try:
     msg = message.payload.decode("utf-8")
     topic = message.topic.split("/")
     if msg == "online" and userdata:
-      gracetime = cfg.get("HASS_BIRTH_GRACETIME", 15)
+      gracetime = config.cfg.get("HASS_BIRTH_GRACETIME", 15)
       logging.info("Received HASS online message. Sending discovery info in {} sec".format(gracetime))
-      time.sleep(gracetime) # dirty workaround: hass requires some grace period for being ready to receive discovery info
-      userdata.send_discovery_info()
+      userdata.schedule_discovery_info(gracetime) # dirty workaround: hass requires some grace period for being ready to receive discovery info
   except Exception as e:
     logging.warning("Error while handling MQTT message: {}".format(str(e)))
 
 def mqtt_start( hass=None ): 
+  global mqtt_client
   try: 
+    cfg = config.cfg
     client = mqttcl.Client(mqttcl.CallbackAPIVersion.VERSION2)
     client.user_data_set(hass) # register home automation instance
     client.username_pw_set(cfg['MQTT_LOGIN'], cfg['MQTT_PASSWORD']) 
-    client.connect(cfg['MQTT_SERVER'], cfg['MQTT_PORT'], keepalive = 60) 
-    if hass:
-      client.subscribe(cfg["HASS_BASE_TOPIC"]+"/status", qos=0)
     client.on_connect = on_mqtt_connect
     client.on_message = on_mqtt_message
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    if cfg['DEBUG'] == True:
+      client.enable_logger()
+    client.connect_async(cfg['MQTT_SERVER'], cfg['MQTT_PORT'], keepalive = 60) # connection is (re-)established by network loop
     client.loop_start()
+    mqtt_client = client
     logging.info('MQTT server started')
     return client
   except Exception as e:
@@ -47,19 +57,35 @@ def mqtt_start( hass=None ):
     return None
 
 def mqtt_stop(client):
+  global mqtt_client
   try: 
-    client.loop_stop()
+    mqtt_client = None
+    client.loop_stop() # sends pending messages before network loop terminates
     logging.info('MQTT server stopped')
   except Exception as e:
     logging.warning("Couldn't stop MQTT: {}".format(str(e)))
 
-def mqtt_publish( topic, payload ):
-  if cfg['MQTT_DISABLE']: # Don't do anything - just logg
-    logging.info("- {}: {}".format(topic, str(payload)))
+def mqtt_publish_batch( items, retain=False ):
+  # Publish a list of [topic, payload] items in one go - returns True if all items have been handed over to the client 
+  if config.cfg['MQTT_DISABLE']: # Don't do anything - just logg
+    for topic, payload in items:
+      logging.info("- {}: {}".format(topic, str(payload)))
+    return True
+  elif not mqtt_client:
+    logging.error("Could't send MQTT command: MQTT client not started")
+    return False
   else:  
-    auth = { 'username': cfg['MQTT_LOGIN'], 'password': cfg['MQTT_PASSWORD'] }  
-    logging.debug("- {}: {}".format(topic, str(payload)))
     try:
-      publish.single(topic, payload=payload, hostname=cfg['MQTT_SERVER'], port=cfg['MQTT_PORT'], auth=auth)
+      rc = mqttcl.MQTT_ERR_SUCCESS
+      for topic, payload in items:
+        logging.debug("- %s: %s", topic, payload) # formatted only if debug logging is enabled
+        info = mqtt_client.publish(topic, payload=payload, qos=0, retain=retain) # queued and sent by network loop
+        if info.rc != mqttcl.MQTT_ERR_SUCCESS: # e.g. not (yet) connected to broker
+          rc = info.rc
+      if rc != mqttcl.MQTT_ERR_SUCCESS:
+        logging.warning("Could't send MQTT messages: {}".format(mqttcl.error_string(rc)))
+        return False
+      return True
     except Exception as e:
       logging.error("Could't send MQTT command: {}".format(str(e)))
+      return False
@@ -3,14 +3,15 @@
 This tool enables to query MTECmodbusapi and export the data in various ways.
 (c) 2024 by Christian Rödel 
 """
-from mtecmqtt.config import cfg, register_groups
+from mtecmqtt import config
 import argparse
+import logging
 import sys
 from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
 
 #-----------------------------
 def parse_options():
-  groups = sorted(register_groups)
+  groups = sorted(config.register_groups)
   groups.append("all")
 
   parser = argparse.ArgumentParser(description='MTEC Modbus data export tool. Allows to read and export Modbus registers from an MTEC inverter.', 
@@ -24,6 +25,7 @@ def parse_options():
  
 #-------------------------------
 def main():
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
   args = parse_options()
   api = MTECmodbusAPI()
   print( "Reading data..." )
@@ -56,17 +58,17 @@ def main():
       registers.append(addr.strip())  
 
   # Do the export
+  cfg = config.cfg
   api.connect( ip_addr=cfg['MODBUS_IP'], port=cfg['MODBUS_PORT'], slave=cfg['MODBUS_SLAVE'] )
   data = api.read_modbus_data( registers=registers )
   api.disconnect()
 
   if data: 
-    for register, item in data.items():
-      if args.csv:
-        line = "{};{};{};{}".format( register, item["name"], item["value"], item["unit"] )
-      else:
-        line = "- {}: {:50s} {} {}".format( register, item["name"], item["value"], item["unit"] )
-      print( line )
+    if args.csv:
+      line_format = "{};{};{};{}\n"
+    else:
+      line_format = "- {}: {:50s} {} {}\n"
+    sys.stdout.writelines( [ line_format.format( register, item["name"], item["value"], item["unit"] ) for register, item in data.items() ] ) # write all lines at once
 
   # cleanup
   if args.file:
@@ -9,98 +9,159 @@ import logging
 FORMAT = '[%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
-from mtecmqtt.config import cfg, register_map
-from datetime import datetime, timedelta
+from mtecmqtt import config
+from datetime import datetime
 import time
 import signal
-from mtecmqtt.mqtt import mqtt_start, mqtt_stop, mqtt_publish
+import threading
+import re
+import functools
+from mtecmqtt.mqtt import mqtt_start, mqtt_stop, mqtt_publish_batch
 from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
 from mtecmqtt.hass_int import HassIntegration
 
+stop_event = threading.Event() # Set to initiate graceful shutdown
+
+NOW_EXT_GROUPS = ( "now-grid", "now-inverter", "now-backup", "now-battery", "now-pv" ) # read in a round robin - one per loop
+
 #----------------------------------
 def signal_handler(signal_number, frame):
-  global run_status
   logging.warning('Received Signal {}. Graceful shutdown initiated.'.format(signal_number))
-  run_status = False
+  stop_event.set() # wakes up the main loop immediately
 
 # =============================================
-# read data from MTEC modbus
-def read_MTEC_data( api, group ):
-  logging.info("Reading registers for group: {}".format(group))
-  registers = api.get_register_list( group )
-  now = datetime.now()
-  data = api.read_modbus_data(registers=registers)
+# Calculation of pseudo-registers
+# Calculated statistics are clamped by max(value, 0), in order to avoid to report negative values, which might occur in some edge cases  
+def _autarky_rate( consumption, grid_purchase ):
+  return max(100*(1 - (grid_purchase / consumption)), 0) if consumption>0 else 0
+
+def _own_consumption_rate( pv, grid_feed ):
+  return max(100*(1 - grid_feed / pv), 0) if pv>0 else 0
+
+# pseudo-register: function(data, pvdata, now)
+PSEUDO_REGISTERS = {
+  "consumption": lambda data, pvdata, now: data["11016"]["value"] - data["11000"]["value"], # power consumption 
+  "consumption-day": lambda data, pvdata, now: max(data["31005"]["value"] + data["31001"]["value"] + data["31004"]["value"] - data["31000"]["value"] - data["31003"]["value"], 0), # power consumption 
+  "autarky-day": lambda data, pvdata, now: _autarky_rate(pvdata["consumption_day"], data["31001"]["value"]),
+  "ownconsumption-day": lambda data, pvdata, now: _own_consumption_rate(data["31005"]["value"], data["31000"]["value"]),
+  "consumption-total": lambda data, pvdata, now: max(data["31112"]["value"] + data["31104"]["value"] + data["31110"]["value"] - data["31102"]["value"] - data["31108"]["value"], 0), # power consumption 
+  "autarky-total": lambda data, pvdata, now: _autarky_rate(pvdata["consumption_total"], data["31104"]["value"]),
+  "ownconsumption-total": lambda data, pvdata, now: _own_consumption_rate(data["31112"]["value"], data["31102"]["value"]),
+  "api-date": lambda data, pvdata, now: now.strftime("%Y-%m-%d %H:%M:%S"), # Local time of this server
+}
+
+# =============================================
+# Per group plan: list of (register, mqtt parameter) for modbus registers and 
+# list of (mqtt parameter, function) for calculated pseudo-registers - built once per group
+group_plans = {}
+
+def get_group_plan( registers, group ):
+  plan = group_plans.get(group)
+  if plan is None:
+    numeric, pseudo = [], []
+    for register in registers:
+      mqtt = config.register_map[register]["mqtt"]
+      if not mqtt:
+        continue
+      if register.isnumeric():  
+        numeric.append( (register, mqtt) )
+      else: # non-numeric registers are deemed to be calculated pseudo-registers
+        calc = PSEUDO_REGISTERS.get(register)
+        if calc:
+          pseudo.append( (mqtt, calc) )
+        else:  
+          logging.warning("Unknown calculated pseudo-register: {}".format(register))
+    plan = group_plans[group] = (numeric, pseudo)
+  return plan
+
+# assign modbus data and calculated pseudo-registers to the mqtt parameters of a group
+def _assign_group_data( data, registers, group, now ):
+  numeric, pseudo = get_group_plan(registers, group)
   pvdata = {}
   try: # assign all data
-    for register in registers:
-      item = register_map[register]
-      if item["mqtt"]:
-        if register.isnumeric():  
-          pvdata[item["mqtt"]] = data[register]
-        else: # non-numeric registers are deemed to be calculated pseudo-registers  
-          if register == "consumption":  
-            pvdata[item["mqtt"]] = data["11016"]["value"] - data["11000"]["value"]  # power consumption 
-          elif register == "consumption-day":
-            pvdata[item["mqtt"]] = data["31005"]["value"] + data["31001"]["value"] + data["31004"]["value"] - data["31000"]["value"] - data["31003"]["value"]  # power consumption 
-          elif register == "autarky-day":
-            pvdata[item["mqtt"]] = 100*(1 - (data["31001"]["value"] / pvdata["consumption_day"])) if pvdata["consumption_day"]>0 else 0
-          elif register == "ownconsumption-day":
-            pvdata[item["mqtt"]] = 100*(1-data["31000"]["value"] / data["31005"]["value"]) if data["31005"]["value"]>0 else 0
-          elif register == "consumption-total":
-            pvdata[item["mqtt"]] = data["31112"]["value"] + data["31104"]["value"] + data["31110"]["value"] - data["31102"]["value"] - data["31108"]["value"]  # power consumption 
-          elif register == "autarky-total":
-            pvdata[item["mqtt"]] = 100*(1 - (data["31104"]["value"] / pvdata["consumption_total"])) if pvdata["consumption_total"]>0 else 0
-          elif register == "ownconsumption-total":
-            pvdata[item["mqtt"]] = 100*(1-data["31102"]["value"] / data["31112"]["value"]) if data["31112"]["value"]>0 else 0
-          elif register == "api-date":    
-            pvdata[item["mqtt"]] = now.strftime("%Y-%m-%d %H:%M:%S") # Local time of this server
-          else:  
-            logging.warning("Unknown calculated pseudo-register: {}".format(register))
-
-          if isinstance(pvdata[item["mqtt"]], float) and pvdata[item["mqtt"]] < 0: # Avoid to report negative values, which might occur in some edge cases  
-            pvdata[item["mqtt"]] = 0 
- 
+    for register, mqtt in numeric:
+      pvdata[mqtt] = data[register]
+    for mqtt, calc in pseudo: # calculated after modbus registers, in register map order
+      pvdata[mqtt] = calc(data, pvdata, now)
   except Exception as e:
-    logging.warning("Retrieved Modbus data is incomplete: {}".format(str(e)))
+    logging.warning("Retrieved Modbus data of group {} is incomplete: {}".format(group, str(e)))
     return None
   return pvdata
 
+# read data from MTEC modbus
+def read_MTEC_data( api, group, now=None ):
+  logging.info("Reading registers for group: {}".format(group))
+  registers = api.get_register_list( group )
+  if not registers:
+    return None
+  if not now:
+    now = datetime.now()
+  data = api.read_modbus_data(registers=registers)
+  return _assign_group_data(data, registers, group, now)
+
+# read data of several groups from MTEC modbus at once - returns dict group -> pvdata
+def read_MTEC_groups( api, groups, now=None ):
+  logging.info("Reading registers for groups: {}".format(", ".join(groups)))
+  group_registers = [ (group, api.get_register_list(group)) for group in groups ]
+  group_registers = [ (group, registers) for group, registers in group_registers if registers ]
+  if not now:
+    now = datetime.now()
+  # one read for all groups, so adjacent registers of different groups share the same modbus request 
+  data = api.read_modbus_data(registers=[ register for group, registers in group_registers for register in registers ])
+  return { group: _assign_group_data(data, registers, group, now) for group, registers in group_registers }
+
 #----------------------------------
 # write data to MQTT
+# Convert a simple "{:.Nf}" format to the faster %-style formatting; other formats use str.format
+@functools.lru_cache(maxsize=None)
+def get_float_formatter( fmt ):
+  match = re.fullmatch(r"\{:(\.\d+)?f\}", fmt)
+  if match:
+    return ("%" + (match.group(1) or "") + "f").__mod__
+  return fmt.format
+
+topic_cache = {} # base_topic -> { param: topic }
+last_published = {} # topic -> [payload, time of publishing]
+
 def write_to_MQTT( pvdata, base_topic ):
+  topics = topic_cache.setdefault(base_topic, {})
+  cfg = config.cfg
+  republish_interval = cfg.get('MQTT_REPUBLISH_INTERVAL', 60)
+  formatters = { float: get_float_formatter(cfg['MQTT_FLOAT_FORMAT']), bool: "{:d}".format } # payload formatter per value type 
+  now = time.monotonic()
+  items = []
   for param, data in pvdata.items():
-    topic = base_topic + param
-    if isinstance(data, dict):
-      if isinstance(data["value"], float):  
-        payload = cfg['MQTT_FLOAT_FORMAT'].format( data["value"] )
-      elif isinstance(data["value"], bool):  
-        payload = "{:d}".format( data["value"] )
-      else:
-        payload = data["value"]
-    else:   
-      if isinstance(data, float):  
-        payload = cfg['MQTT_FLOAT_FORMAT'].format( data )
-      elif isinstance(data, bool):  
-        payload = "{:d}".format( data )
-      else:
-        payload = data  
-    mqtt_publish( topic, payload )
+    topic = topics.get(param)
+    if not topic:
+      topic = topics[param] = base_topic + param
+    value = data["value"] if type(data) is dict else data # register data or calculated value 
+    formatter = formatters.get(type(value))
+    payload = formatter(value) if formatter else value # other types are published as they are
+
+    # Skip unchanged values - but re-publish them every republish_interval seconds 
+    last = last_published.get(topic)
+    if last and last[0] == payload and now - last[1] < republish_interval:
+      continue
+    items.append( [topic, payload] )
+  if mqtt_publish_batch( items, retain=True ): # publish all values of the group in one go; retained for late subscribers
+    for topic, payload in items: # remember only values which were actually sent, e.g. not while the broker is unavailable
+      last_published[topic] = [payload, now]
 
 #==========================================
 def main():
-  global run_status
-  run_status = True 
-
   # Initialization
   signal.signal(signal.SIGTERM, signal_handler)
   signal.signal(signal.SIGINT, signal_handler)
+  cfg = config.cfg
   if cfg['DEBUG'] == True:
     logging.getLogger().setLevel(logging.DEBUG)
   logging.info("Starting")
 
-  next_read_config = datetime.now()
-  next_read_day = datetime.now()
-  next_read_total = datetime.now()
+  refresh_now = cfg['REFRESH_NOW']
+  refresh_day = cfg['REFRESH_DAY']
+  refresh_total = cfg['REFRESH_TOTAL']
+  refresh_config = cfg['REFRESH_CONFIG']
+  next_read_config = next_read_day = next_read_total = time.monotonic() # schedule is based on monotonic clock, so it's not affected by changes of the system time
   now_ext_idx = 0
   topic_base = None
   
@@ -119,71 +180,45 @@ def main():
     pv_config = read_MTEC_data( api, "config" )
     if not pv_config:
       logging.warning("Cant retrieve initial config - retry in 10 s")
-      time.sleep(10)
+      if stop_event.wait(10):
+        api.disconnect()
+        mqtt_stop(mqttclient)
+        logging.info("Exiting")
+        return
   
   topic_base = cfg['MQTT_TOPIC'] + '/' + pv_config["serial_no"]["value"] + '/'  
+  group_topics = { group: topic_base + group + '/' for group in config.register_groups } # topic prefix per group - built only once
   if hass and not hass.is_initialized:
     hass.initialize( pv_config["serial_no"]["value"] )
 
   # Main loop - exit on signal only
-  while run_status: 
-    now = datetime.now()
-
-    # Now base
-    pvdata = read_MTEC_data( api, "now-base" )
-    if pvdata:
-      write_to_MQTT( pvdata, topic_base + 'now-base/' )
-
-    # Now extended - read groups in a round robin - one per loop
-    if now_ext_idx == 0:
-      pvdata = read_MTEC_data( api, "now-grid" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-grid/' )
-    elif now_ext_idx == 1:
-      pvdata = read_MTEC_data( api, "now-inverter" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-inverter/' )
-    elif now_ext_idx == 2:
-      pvdata = read_MTEC_data( api, "now-backup" )
+  while not stop_event.is_set(): 
+    cycle_start = time.monotonic()
+    now = datetime.now() # Local time, only used for the api-date pseudo-register
+
+    # Collect all groups due in this cycle, in order to read them at once
+    groups = [ "now-base", NOW_EXT_GROUPS[now_ext_idx] ] # Now extended - read groups in a round robin - one per loop
+    now_ext_idx = (now_ext_idx + 1) % len(NOW_EXT_GROUPS)
+    if next_read_day <= cycle_start:
+      groups.append("day")
+    if next_read_total <= cycle_start:
+      groups.append("total")
+    if next_read_config <= cycle_start:
+      groups.append("config")
+
+    for group, pvdata in read_MTEC_groups( api, groups, now ).items():
       if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-backup/' )
-    elif now_ext_idx == 3:
-      pvdata = read_MTEC_data( api, "now-battery" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-battery/' )
-    elif now_ext_idx == 4:
-      pvdata = read_MTEC_data( api, "now-pv" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'now-pv/' )
-    
-    if now_ext_idx >= 4:
-      now_ext_idx = 0
-    else:  
-      now_ext_idx += 1
-
-    # Day
-    if next_read_day <= now:
-      pvdata = read_MTEC_data( api, "day" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'day/' )
-        next_read_day = datetime.now() + timedelta(seconds=cfg['REFRESH_DAY'])
-
-    # Total
-    if next_read_total <= now:
-      pvdata = read_MTEC_data( api, "total" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'total/' )
-        next_read_total = datetime.now() + timedelta(seconds=cfg['REFRESH_TOTAL'])
-
-    # Config
-    if next_read_config <= now:
-      pvdata = read_MTEC_data( api, "config" )
-      if pvdata:
-        write_to_MQTT( pvdata, topic_base + 'config/' )
-        next_read_config = datetime.now() + timedelta(seconds=cfg['REFRESH_CONFIG'])
-
-    logging.debug("Sleep {}s".format( cfg['REFRESH_NOW'] ))
-    time.sleep(cfg['REFRESH_NOW'])
+        write_to_MQTT( pvdata, group_topics[group] )
+        if group == "day":
+          next_read_day = cycle_start + refresh_day
+        elif group == "total":
+          next_read_total = cycle_start + refresh_total
+        elif group == "config":
+          next_read_config = cycle_start + refresh_config
+
+    delay = max(0, cycle_start + refresh_now - time.monotonic()) # time spent for reading and publishing doesn't delay the next cycle
+    logging.debug("Sleep {:.3f}s".format( delay ))
+    stop_event.wait(delay) # returns early on shutdown signal
 
   # clean up
   if hass:
@@ -5,12 +5,32 @@ This is a test utility for MTECmodbusapi.
 """
 
 import logging
+import sys
+import functools
 FORMAT = '[%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.INFO)
 
-from mtecmqtt.config import cfg, register_map, register_groups
+from mtecmqtt import config
 from mtecmqtt.MTECmodbusAPI import MTECmodbusAPI
 
+#-------------------------------
+# The register map is static, so it is sorted only once (on first use)
+@functools.lru_cache(maxsize=None)
+def get_register_map_sorted():
+  return sorted(config.register_map.items())
+
+@functools.lru_cache(maxsize=None)
+def get_register_map_sorted_by_group():
+  return { group: [ (register, item) for register, item in get_register_map_sorted() if item["group"]==group ] for group in config.register_groups }
+
+@functools.lru_cache(maxsize=None)
+def get_writable_registers():
+  return [ (register, item) for register, item in get_register_map_sorted() if item["writable"] ]
+
+@functools.lru_cache(maxsize=None)
+def get_groups_banner():
+  return "Groups: " + ", ".join(sorted(config.register_groups)) + ", all"
+
 #-------------------------------
 def read_register(api):
   print( "-------------------------------------" )
@@ -23,10 +43,7 @@ def read_register(api):
 #-------------------------------
 def read_register_group(api):
   print( "-------------------------------------" )
-  line = "Groups: "
-  for g in sorted(register_groups):
-    line += g + ", "  
-  print( line + "all" )
+  print( get_groups_banner() )
 
   group = input("Register group (or RETURN for all): ")
   if group=="" or group=="all":
@@ -39,8 +56,7 @@ def read_register_group(api):
   print( "Reading..." )
   data = api.read_modbus_data( registers=registers )
   if data: 
-    for register, item in data.items():
-      print("- {}: {:50s} {} {}".format( register, item["name"], item["value"], item["unit"]))
+    sys.stdout.writelines( [ "- {}: {:50s} {} {}\n".format( register, item["name"], item["value"], item["unit"]) for register, item in data.items() ] ) # write all lines at once
 
 #-------------------------------
 def write_register(api):
@@ -48,15 +64,12 @@ def write_register(api):
   print( "Current settings of writable registers:" )
   print( "Reg   Name                           Value  Unit" )
   print( "----- ------------------------------ ------ ----" )
-  register_map_sorted = dict(sorted(register_map.items()))
-  for register, item in register_map_sorted.items():
-    if item["writable"]: 
-      data = api.read_modbus_data( registers=[register] )
-      value = ""
-      if data: 
-        value = data[register]["value"]
-      unit = item["unit"] if item["unit"] else ""
-      print("{:5s} {:30s} {:6s} {:4s} ".format(register, item["name"], str(value), unit ))
+  writable_registers = get_writable_registers()
+  data = api.read_modbus_data( registers=[ register for register, item in writable_registers ] ) # read all at once
+  for register, item in writable_registers:
+    value = data[register]["value"] if register in data else ""
+    unit = item["unit"] if item["unit"] else ""
+    print("{:5s} {:30s} {:6s} {:4s} ".format(register, item["name"], str(value), unit ))
 
   print( "" )
   register = input("Register: ")
@@ -78,38 +91,40 @@ def list_register_config(api):
   print( "-------------------------------------" )
   print( "Reg   MQTT Parameter                 Unit Mode Group           Name                   " )
   print( "----- ------------------------------ ---- ---- --------------- -----------------------" )
-  register_map_sorted = dict(sorted(register_map.items()))
-  for register, item in register_map_sorted.items():
+  lines = []
+  for register, item in get_register_map_sorted():
     if not register.isnumeric(): # non-numeric registers are deemed to be calculated pseudo-registers
       register = "" 
     mqtt = item["mqtt"] if item["mqtt"] else ""
     unit = item["unit"] if item["unit"] else ""
     group = item["group"] if item["group"] else ""
     mode = "RW" if item["writable"] else "R"
-    print("{:5s} {:30s} {:4s} {:4s} {:15s} {}".format(register, mqtt, unit, mode, group, item["name"]))
+    lines.append("{:5s} {:30s} {:4s} {:4s} {:15s} {}\n".format(register, mqtt, unit, mode, group, item["name"]))
+  sys.stdout.writelines(lines) # write all lines at once
  
 #-------------------------------
 def list_register_config_by_groups(api):
-  for group in register_groups:  
+  for group in config.register_groups:  
     print( "-------------------------------------" )
     print( "Group {}:".format(group) ) 
     print( "" )
     print( "Reg   MQTT Parameter                 Unit Mode Name                   " )
     print( "----- ------------------------------ ---- ---- -----------------------" )
-    register_map_sorted = dict(sorted(register_map.items()))
-    for register, item in register_map_sorted.items():
-      if item["group"]==group: 
-        if not register.isnumeric(): # non-nu1meric registers are deemed to be calculated pseudo-registers
-          register = "" 
-        mqtt = item["mqtt"] if item["mqtt"] else ""
-        unit = item["unit"] if item["unit"] else ""
-        mode = "RW" if item["writable"] else "R"
-        print("{:5s} {:30s} {:4s} {:4s} {}".format(register, mqtt, unit, mode, item["name"]))
+    lines = []
+    for register, item in get_register_map_sorted_by_group()[group]:
+      if not register.isnumeric(): # non-numeric registers are deemed to be calculated pseudo-registers
+        register = "" 
+      mqtt = item["mqtt"] if item["mqtt"] else ""
+      unit = item["unit"] if item["unit"] else ""
+      mode = "RW" if item["writable"] else "R"
+      lines.append("{:5s} {:30s} {:4s} {:4s} {}\n".format(register, mqtt, unit, mode, item["name"]))
+    sys.stdout.writelines(lines) # write all lines at once
     print( "" )
 
 #-------------------------------
 def main(): 
   api = MTECmodbusAPI()
+  cfg = config.cfg
   api.connect( ip_addr=cfg['MODBUS_IP'], port=cfg['MODBUS_PORT'], slave=cfg['MODBUS_SLAVE'] )
 
   while True: